@@ -1,11 +1,90 @@
-import os, json, requests, re
+import os, re, sys, asyncio, time, itertools, hashlib
+import diskcache
+import httpx
+import openai
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from prompt_toolkit import PromptSession
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
+# ---- Configuration (environment is read once, here) ----
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 WEATHER_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY")
-MODEL = "gpt-3.5-turbo"
+INSTRUCTION_VARIANT = os.getenv("INSTRUCTION_VARIANT", "detailed")
+# the first (tool-decision) turn only picks a function and extracts fields, so it runs on a fast model;
+# turns after tool output write the user-facing answer
+ROUTER_MODEL = "gpt-4o-mini"
+RESPONDER_MODEL = "gpt-4o-mini"
+# worst case the prompt invites: a direct hop-0 answer, and a comparison of two 30-day itineraries
+# (~40 tokens/day each plus overview and differences, ~3k tokens). Replies that still hit the cap
+# end with TRUNCATED_NOTE instead of passing as complete.
+ROUTER_MAX_TOKENS = 1024
+RESPONDER_MAX_TOKENS = 4096
+TRUNCATED_NOTE = "\n\n(This answer was cut off at the length limit. Ask me to continue, or narrow the request.)"
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+FRANKFURTER_URL = "https://api.frankfurter.dev/v1/latest"
+# pinned sampling so a given (model, messages, tools) reliably maps to one reply, which is what makes caching sound
+TEMPERATURE = 0
+SEED = 42
+# first-turn reply cache; lives next to this file (not the cwd) and is only opened once it is needed
+LLM_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache")
+LLM_CACHE_TTL_SECONDS = 24 * 3600
+_LLM_CACHE: diskcache.Cache | None = None
+
+def _get_llm_cache() -> diskcache.Cache:
+    global _LLM_CACHE
+    if _LLM_CACHE is None:
+        _LLM_CACHE = diskcache.Cache(LLM_CACHE_DIR)
+    return _LLM_CACHE
+
+def _dumps(obj) -> str:
+    # orjson returns bytes; the OpenAI SDK expects tool content as str
+    return orjson.dumps(obj).decode()
+
+# Hot tool functions below bind the globals they use as default arguments (`_dumps=_dumps`, ...):
+# CPython resolves those as fast locals instead of a dict lookup on every access.
+
+# ---- Shared HTTP clients (HTTP/2: concurrent calls multiplex over one connection per host) ----
+# Connection pools belong to the event loop that opened them, so each client is created lazily for
+# the running loop and replaced if a later asyncio.run() asks for it from a different loop.
+_http_client: httpx.AsyncClient | None = None
+_http_client_loop: asyncio.AbstractEventLoop | None = None
+_openai_client: AsyncOpenAI | None = None
+_openai_client_loop: asyncio.AbstractEventLoop | None = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Weather + FX client for the running loop."""
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+        _http_client_loop = loop
+    return _http_client
+
+def _get_openai_client() -> AsyncOpenAI:
+    """OpenAI client for the running loop."""
+    global _openai_client, _openai_client_loop
+    loop = asyncio.get_running_loop()
+    if _openai_client is None or _openai_client.is_closed() or _openai_client_loop is not loop:
+        _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=DefaultAsyncHttpxClient(http2=True))
+        _openai_client_loop = loop
+    return _openai_client
+
+async def close_http_clients() -> None:
+    """Close the running loop's clients; the next call after this opens fresh ones."""
+    global _http_client, _openai_client
+    loop = asyncio.get_running_loop()
+    if _http_client is not None and _http_client_loop is loop:
+        await _http_client.aclose()
+    if _openai_client is not None and _openai_client_loop is loop:
+        await _openai_client.close()
+    _http_client = _openai_client = None
 
 # ---- Travel Planner instruction variants (kept minimal; select via env INSTRUCTION_VARIANT) ----
 INSTRUCTION_VARIANTS = {
@@ -84,7 +163,7 @@ def _compose_system_prompt(variant_name: str) -> str:
 - If the user asks to plan a trip, call plan_trip(destination, duration_days, interests).
 - If no interests provided, use ["general"].
 - If the user gives a duration in words (e.g., “a week”), interpret it (week=7, weekend=2/3).
-- If the user asks to compare destinations for the same duration/interests, call plan_trip separately for EACH destination, then present both itineraries succinctly and highlight differences.
+- If the user asks to compare destinations for the same duration/interests, call plan_trip for EACH destination (emit all of those calls together in the same turn), then present both itineraries succinctly and highlight differences.
 - Keep responses concise and actionable. If the tool returns an error, ask the user for the missing details (destination, days, interests).
 - IMPORTANT: Only use ONE of the four skills per request. If user intent clearly matches Travel Planner, do NOT call weather or converters.
 
@@ -92,24 +171,25 @@ def _compose_system_prompt(variant_name: str) -> str:
 """
     return f"{base_prompt}{travel_variant}\n"
 
-SYSTEM_PROMPT = _compose_system_prompt(os.getenv("INSTRUCTION_VARIANT", "detailed"))
+SYSTEM_PROMPT = _compose_system_prompt(INSTRUCTION_VARIANT)
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}  # shared by every conversation; never mutated
 
 # ---- Weather ----
-def get_weather(city: str) -> str:
-    api_url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric"
+async def get_weather(city: str, _dumps=_dumps) -> str:
+    params = {"q": city, "appid": WEATHER_API_KEY, "units": "metric"}
     try:
-        response = requests.get(api_url, timeout=10)
-    except requests.RequestException:
-        return json.dumps({"error": "network_error"})
+        response = await _get_http_client().get(WEATHER_URL, params=params)
+        payload = orjson.loads(response.content) if response.status_code == 200 else None
+    except (httpx.HTTPError, ValueError):
+        return _dumps({"error": "network_error"})
     if response.status_code == 200:
-        payload = response.json()
         weather_info = {
             "city": city,
             "temperature_c": payload.get("main", {}).get("temp"),
             "description": (payload.get("weather") or [{}])[0].get("description")
         }
-        return json.dumps(weather_info)
-    return json.dumps({"error": "Could not get weather"})
+        return _dumps(weather_info)
+    return _dumps({"error": "Could not get weather"})
 
 # ---- Simple unit conversions (mi↔km, kg↔lb, C↔F) ----
 ALIASES = {
@@ -122,81 +202,120 @@ ALIASES = {
 }
 FACTORS = {("mile", "kilometer"): 1.60934, ("kilogram", "pound"): 2.20462}
 
-def convert_units(value: float, from_unit: str, to_unit: str) -> str:
+def _build_conv_table() -> dict:
+    # every supported (from, to) pair -> converter, both directions plus identity
+    table = {}
+    for (a, b), k in FACTORS.items():
+        table[(a, b)] = (lambda k: lambda v: v * k)(k)
+        table[(b, a)] = (lambda k: lambda v: v / k)(k)
+    table[("celsius", "fahrenheit")] = lambda v: v * 9/5 + 32
+    table[("fahrenheit", "celsius")] = lambda v: (v - 32) * 5/9
+    for unit in set(ALIASES.values()):
+        table[(unit, unit)] = lambda v: v
+    return table
+
+_CONV = _build_conv_table()  # built once at import
+
+def convert_units(value: float, from_unit: str, to_unit: str, _dumps=_dumps, _aliases=ALIASES, _conv=_CONV) -> str:
     try:
         value_float = float(value)
     except (TypeError, ValueError):
-        return json.dumps({"error": "invalid_value"})
-
-    from_normalized = ALIASES.get((from_unit or "").strip().lower(), "")
-    to_normalized = ALIASES.get((to_unit or "").strip().lower(), "")
+        return _dumps({"error": "invalid_value"})
 
-    if not from_normalized or not to_normalized:
-        return json.dumps({"error": "unsupported"})
-
-    if from_normalized == to_normalized:
-        return json.dumps({
-            "value": value_float,
-            "from_unit": from_normalized,
-            "to_unit": to_normalized,
-            "converted_value": value_float
-        })
-
-    if {from_normalized, to_normalized} == {"celsius", "fahrenheit"}:
-        converted_value = (
-            value_float * 9/5 + 32
-            if from_normalized == "celsius"
-            else (value_float - 32) * 5/9
-        )
-        return json.dumps({
-            "value": value_float,
-            "from_unit": from_normalized,
-            "to_unit": to_normalized,
-            "converted_value": converted_value
-        })
+    from_normalized = _aliases.get((from_unit or "").strip().lower(), "")
+    to_normalized = _aliases.get((to_unit or "").strip().lower(), "")
 
-    if (from_normalized, to_normalized) in FACTORS:
-        converted_value = value_float * FACTORS[(from_normalized, to_normalized)]
-    elif (to_normalized, from_normalized) in FACTORS:
-        converted_value = value_float / FACTORS[(to_normalized, from_normalized)]
-    else:
-        return json.dumps({"error": "unsupported"})
+    converter = _conv.get((from_normalized, to_normalized))
+    if converter is None:
+        return _dumps({"error": "unsupported"})
 
-    return json.dumps({
+    return _dumps({
         "value": value_float,
         "from_unit": from_normalized,
         "to_unit": to_normalized,
-        "converted_value": converted_value
+        "converted_value": converter(value_float)
     })
 
 # ---- Currency conversion via Frankfurter (no API key) ----
-def convert_currency(amount: float, from_currency: str, to_currency: str) -> str:
+# Frankfurter publishes rates once per working day, so each base table is kept in memory for an hour.
+FX_CACHE_TTL_SECONDS = 3600
+FX_CACHE_MAXSIZE = 512
+_FX_CACHE: dict[str, tuple[float, dict]] = {}  # base -> (fetched_at, payload)
+
+# base -> in-flight download, so concurrent misses share one GET. Tasks (not asyncio.Lock, which binds
+# to the first loop that waits on it) keep this safe across separate asyncio.run() calls.
+_FX_PENDING: dict[str, asyncio.Task] = {}
+
+async def _download_rates(base: str) -> dict | None:
+    response = await _get_http_client().get(FRANKFURTER_URL, params={"base": base})
+    if response.status_code != 200:
+        return None
+    data = orjson.loads(response.content)
+
+    _FX_CACHE.pop(base, None)
+    if len(_FX_CACHE) >= FX_CACHE_MAXSIZE:
+        _FX_CACHE.pop(next(iter(_FX_CACHE)))  # evict the oldest entry
+    _FX_CACHE[base] = (time.monotonic(), data)
+    return data
+
+async def _fetch_rates(base: str) -> dict | None:
+    """Return the latest Frankfurter payload for `base` (all symbols), or None on an API error."""
+    cached = _FX_CACHE.get(base)
+    if cached is not None and time.monotonic() - cached[0] < FX_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    task = _FX_PENDING.get(base)
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        task = asyncio.ensure_future(_download_rates(base))
+        _FX_PENDING[base] = task
+
+        def _forget(done: asyncio.Task) -> None:
+            if _FX_PENDING.get(base) is done:
+                del _FX_PENDING[base]
+        task.add_done_callback(_forget)
+    # shield: one waiter being cancelled must not cancel the download the others are waiting on
+    return await asyncio.shield(task)
+
+# common pairs warmed in the background by the REPL; the cache is per base, so this fetches USD and EUR
+PREFETCH_PAIRS = (("USD", "EUR"), ("USD", "GBP"), ("EUR", "USD"))
+FX_REFRESH_SECONDS = 30
+
+async def _prefetch_rates(pairs=PREFETCH_PAIRS) -> None:
+    bases = {base for base, _ in pairs}
+    # best-effort warm-up: a failure here just means the first real conversion goes to the network
+    await asyncio.gather(*(_fetch_rates(base) for base in bases), return_exceptions=True)
+
+async def _keep_rates_warm(pairs=PREFETCH_PAIRS, interval: float = FX_REFRESH_SECONDS) -> None:
+    # _fetch_rates only goes to the network once an entry has expired, so this is cheap between refreshes
+    while True:
+        await _prefetch_rates(pairs)
+        await asyncio.sleep(interval)
+
+async def convert_currency(amount: float, from_currency: str, to_currency: str, _dumps=_dumps) -> str:
     try:
         amount_float = float(amount)
     except (TypeError, ValueError):
-        return json.dumps({"error": "invalid_amount"})
+        return _dumps({"error": "invalid_amount"})
 
     from_code = (from_currency or "").strip().upper()
     to_code = (to_currency or "").strip().upper()
     if not from_code or not to_code:
-        return json.dumps({"error": "unsupported_currency"})
+        return _dumps({"error": "unsupported_currency"})
     if from_code == to_code:
-        return json.dumps({
+        return _dumps({
             "amount": amount_float, "from": from_code, "to": to_code,
             "rate": 1.0, "converted": amount_float
         })
 
-    api_url = f"https://api.frankfurter.dev/v1/latest?base={from_code}&symbols={to_code}"
     try:
-        response = requests.get(api_url, timeout=10)
-        if response.status_code != 200:
-            return json.dumps({"error": "api_error"})
-        data = response.json()
+        data = await _fetch_rates(from_code)
+        if data is None:
+            return _dumps({"error": "api_error"})
         rate_value = (data.get("rates") or {}).get(to_code)
         if rate_value is None:
-            return json.dumps({"error": "unsupported_currency"})
+            return _dumps({"error": "unsupported_currency"})
         converted_amount = amount_float * float(rate_value)
-        return json.dumps({
+        return _dumps({
             "amount": amount_float,
             "from": from_code,
             "to": to_code,
@@ -206,7 +325,7 @@ def convert_currency(amount: float, from_currency: str, to_currency: str) -> str
             "base": data.get("base")
         })
     except Exception:
-        return json.dumps({"error": "api_error"})
+        return _dumps({"error": "api_error"})
 
 # ---- NEW: Travel Planner tool (offline generator) ----
 _INTEREST_BANK = {
@@ -244,6 +363,18 @@ _INTEREST_BANK = {
     ]
 }
 
+MAX_TRIP_DAYS = 30
+
+# (morning, afternoon, evening) picks for every theme and day 1..MAX_TRIP_DAYS, built once at import
+_PRECOMP = {
+    theme: tuple(
+        (ideas[(day * 1) % n], ideas[(day * 2) % n], ideas[(day * 3) % n])
+        for day in range(1, MAX_TRIP_DAYS + 1)
+    )
+    for theme, ideas in _INTEREST_BANK.items()
+    for n in [len(ideas)]
+}
+
 def _sanitize_interests(interests):
     if not interests:
         return ["general"]
@@ -253,32 +384,24 @@ def _sanitize_interests(interests):
         normalized_interests.append(key if key in _INTEREST_BANK else "general")
     return normalized_interests or ["general"]
 
-def plan_trip(destination: str, duration_days: int, interests: list[str]) -> str:
+def plan_trip(destination: str, duration_days: int, interests: list[str], _dumps=_dumps, _precomp=_PRECOMP) -> str:
     if not destination or not isinstance(destination, str):
-        return json.dumps({"error": "missing_destination"})
+        return _dumps({"error": "missing_destination"})
     try:
         duration_int = int(duration_days)
     except Exception:
-        return json.dumps({"error": "invalid_duration"})
-    duration_int = max(1, min(duration_int, 30))
+        return _dumps({"error": "invalid_duration"})
+    duration_int = max(1, min(duration_int, MAX_TRIP_DAYS))
 
     normalized_interests = _sanitize_interests(interests)
-    itinerary_days = []
-    for day_index in range(1, duration_int + 1):
-        theme = normalized_interests[(day_index - 1) % len(normalized_interests)]
-        idea_list = _INTEREST_BANK.get(theme, _INTEREST_BANK["general"])
-        morning_activity = idea_list[(day_index * 1) % len(idea_list)]
-        afternoon_activity = idea_list[(day_index * 2) % len(idea_list)]
-        evening_activity = idea_list[(day_index * 3) % len(idea_list)]
-        itinerary_days.append({
-            "day": day_index,
-            "theme": theme,
-            "morning": morning_activity,
-            "afternoon": afternoon_activity,
-            "evening": evening_activity
-        })
+    themes_cycle = itertools.islice(itertools.cycle(normalized_interests), duration_int)
+    itinerary_days = [
+        {"day": day, "theme": theme, "morning": morning, "afternoon": afternoon, "evening": evening}
+        for day, theme in enumerate(themes_cycle, start=1)
+        for morning, afternoon, evening in [_precomp[theme][day - 1]]
+    ]
 
-    return json.dumps({
+    return _dumps({
         "destination": destination,
         "duration_days": duration_int,
         "interests": normalized_interests,
@@ -320,11 +443,13 @@ FUNCTIONS = [
         }, "required": ["destination","duration_days","interests"]},
     },
 ]
+# built once at import
+TOOLS = tuple({"type": "function", "function": spec} for spec in FUNCTIONS)
 
 # ---- Dispatcher that supports MULTIPLE tool calls (important for comparisons) ----
-def _call_tool(name: str, args: dict) -> str:
+async def _call_tool(name: str, args: dict) -> str:
     if name == "get_weather":
-        return get_weather(city=args.get("city", ""))
+        return await get_weather(city=args.get("city", ""))
     if name == "convert_units":
         return convert_units(
             value=args.get("value", 0),
@@ -332,7 +457,7 @@ def _call_tool(name: str, args: dict) -> str:
             to_unit=args.get("to_unit", "")
         )
     if name == "convert_currency":
-        return convert_currency(
+        return await convert_currency(
             amount=args.get("amount", 0),
             from_currency=args.get("from_currency", ""),
             to_currency=args.get("to_currency", "")
@@ -343,38 +468,284 @@ def _call_tool(name: str, args: dict) -> str:
             duration_days=args.get("duration_days", 0),
             interests=args.get("interests", []),
         )
-    return json.dumps({"error": "unknown_tool"})
+    return _dumps({"error": "unknown_tool"})
 
-def run_conversation(user_input: str) -> str:
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_input},
-    ]
+async def _call_tool_call(tool_call: dict) -> str:
+    function = tool_call.get("function") or {}
+    try:
+        tool_args = orjson.loads(function.get("arguments") or "{}")
+    except orjson.JSONDecodeError:
+        return _dumps({"error": "invalid_arguments"})
+    return await _call_tool(function.get("name", ""), tool_args)
+
+# ---- Local answers for templated skills (skips the paraphrasing LLM round-trip) ----
+UNSUPPORTED_CONVERSION_REPLY = "Sorry, I don’t support that conversion yet."
+# convert_units reports canonical names ("mile"); answers use the short symbols the prompt lists
+UNIT_LABELS = {
+    "mile": "mi", "kilometer": "km", "kilogram": "kg", "pound": "lb",
+    "celsius": "°C", "fahrenheit": "°F",
+}
 
-    max_tool_hops = 6  # safety cap
-    for _ in range(max_tool_hops):
-        response = client.chat.completions.create(
-            model=MODEL, messages=messages, functions=FUNCTIONS, function_call="auto"
+def _render_conversion(name: str, tool_output: str) -> str | None:
+    """Render the system prompt's canned sentence for a converter result; None if the model is needed."""
+    data = orjson.loads(tool_output)
+    error = data.get("error")
+    if error in ("unsupported", "unsupported_currency"):
+        return UNSUPPORTED_CONVERSION_REPLY
+    if error:
+        return None  # invalid input / API trouble: let the model ask a follow-up
+    if name == "convert_units":
+        from_label = UNIT_LABELS.get(data["from_unit"], data["from_unit"])
+        to_label = UNIT_LABELS.get(data["to_unit"], data["to_unit"])
+        return f"{data['value']:.2f} {from_label} is equal to {data['converted_value']:.2f} {to_label}."
+    if name == "convert_currency":
+        return f"{data['amount']:.2f} {data['from']} is equal to {data['converted']:.2f} {data['to']}."
+    return None
+
+def _render_locally(tool_calls: list[dict], tool_outputs: list[str]) -> str | None:
+    """Answer without another completion when every call in the turn is a converter; else None."""
+    lines = []
+    for tool_call, tool_output in zip(tool_calls, tool_outputs):
+        line = _render_conversion((tool_call.get("function") or {}).get("name", ""), tool_output)
+        if line is None:
+            return None
+        lines.append(line)
+    return "\n".join(lines) or None
+
+async def _create_completion(limiter=None, **kwargs):
+    # every chat completion goes through here, so a batch limiter sees (and throttles) each one
+    if limiter is None:
+        return await _get_openai_client().chat.completions.create(**kwargs)
+    return await limiter.create(**kwargs)
+
+async def _stream_completion(messages: list, on_token, limiter=None) -> tuple[str, list[dict], bool]:
+    """Stream one responder completion, forwarding content deltas to `on_token`;
+    returns (content, tool_calls, truncated)."""
+    stream = await _create_completion(
+        limiter,
+        model=RESPONDER_MODEL, messages=messages, tools=TOOLS, tool_choice="auto", parallel_tool_calls=True,
+        temperature=TEMPERATURE, seed=SEED, max_tokens=RESPONDER_MAX_TOKENS, stream=True,
+    )
+    content_parts = []
+    tool_calls_by_index: dict[int, dict] = {}
+    truncated = False
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        if chunk.choices[0].finish_reason == "length":
+            truncated = True
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content_parts.append(delta.content)
+            on_token(delta.content)
+        # tool calls arrive as fragments keyed by index; stitch name/arguments back together
+        for fragment in delta.tool_calls or []:
+            entry = tool_calls_by_index.setdefault(
+                fragment.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+            )
+            if fragment.id:
+                entry["id"] = fragment.id
+            if fragment.function:
+                entry["function"]["name"] += fragment.function.name or ""
+                entry["function"]["arguments"] += fragment.function.arguments or ""
+    return "".join(content_parts), [tool_calls_by_index[i] for i in sorted(tool_calls_by_index)], truncated
+
+async def _complete(
+    messages: list, model: str, max_tokens: int, use_cache: bool = False, limiter=None
+) -> tuple[str | None, list[dict], bool]:
+    """One non-streamed completion; returns (content, tool_calls, truncated). With `use_cache`,
+    complete tool-calling replies are memoized on disk (for LLM_CACHE_TTL_SECONDS) by a hash of
+    everything that determines them."""
+    cache_key = None
+    if use_cache:
+        cache_key = hashlib.blake2b(
+            orjson.dumps((model, messages, TOOLS, TEMPERATURE, SEED)), digest_size=16
+        ).hexdigest()
+        cached = _get_llm_cache().get(cache_key)
+        if cached is not None:
+            return cached["content"], cached["tool_calls"], False
+
+    response = await _create_completion(
+        limiter,
+        model=model, messages=messages, tools=TOOLS, tool_choice="auto", parallel_tool_calls=True,
+        temperature=TEMPERATURE, seed=SEED, max_tokens=max_tokens,
+    )
+    choice = response.choices[0]
+    content = choice.message.content
+    tool_calls = [tool_call.model_dump() for tool_call in choice.message.tool_calls or []]
+    truncated = choice.finish_reason == "length"
+    # only complete routing decisions are cached: a direct reply (e.g. a clarifying question) is not worth pinning
+    if cache_key is not None and tool_calls and not truncated:
+        _get_llm_cache().set(
+            cache_key, {"content": content, "tool_calls": tool_calls}, expire=LLM_CACHE_TTL_SECONDS
         )
-        message = response.choices[0].message
+    return content, tool_calls, truncated
+
+async def run_conversation(user_input: str, on_token=None, limiter=None) -> str:
+    """Answer `user_input`. If `on_token` is given, the answer is also written through it, streamed
+    token by token whenever it comes from a post-tool completion, and the return value is exactly
+    the text that was written (including content streamed by turns that went on to call tools).
+    `limiter` (see run_batch) throttles and retries each completion this conversation makes."""
+    messages = [SYSTEM_MSG, {"role": "user", "content": user_input}]
+    transcript: list[str] = []  # everything forwarded to on_token
+
+    def _turn_writer():
+        # one writer per model turn, so separate turns don't run together on screen
+        started = False
+
+        def write(text: str) -> None:
+            nonlocal started
+            if not text:
+                return
+            if not started and transcript:
+                on_token("\n")
+                transcript.append("\n")
+            started = True
+            on_token(text)
+            transcript.append(text)
+        return write
+
+    def _finish(answer: str) -> str:
+        if on_token is None:
+            return answer
+        _turn_writer()(answer)
+        return "".join(transcript)
 
-        if getattr(message, "function_call", None):
-            tool_name = message.function_call.name
-            tool_args = json.loads(message.function_call.arguments or "{}")
-            tool_output = _call_tool(tool_name, tool_args)
-            messages.append({"role": "function", "name": tool_name, "content": tool_output})
+    max_tool_hops = 6  # safety cap
+    for hop in range(max_tool_hops):
+        write = None
+        if on_token is not None and hop > 0:
+            # after tools ran, the next reply is usually the long final answer: stream it
+            write = _turn_writer()
+            content, tool_calls, truncated = await _stream_completion(messages, write, limiter)
+        else:
+            # the tool-decision turn is short and needs complete arguments, so it is not streamed.
+            # Only that first turn is cached: later turns carry freshly fetched tool data.
+            if hop == 0:
+                content, tool_calls, truncated = await _complete(
+                    messages, ROUTER_MODEL, ROUTER_MAX_TOKENS, use_cache=True, limiter=limiter
+                )
+            else:
+                content, tool_calls, truncated = await _complete(
+                    messages, RESPONDER_MODEL, RESPONDER_MAX_TOKENS, limiter=limiter
+                )
+
+        if tool_calls:
+            messages.append({"role": "assistant", "content": content or None, "tool_calls": tool_calls})
+            # run every tool call from this turn concurrently (e.g. both sides of a comparison)
+            tool_outputs = await asyncio.gather(*(_call_tool_call(tc) for tc in tool_calls))
+            for tool_call, tool_output in zip(tool_calls, tool_outputs):
+                messages.append({"role": "tool", "tool_call_id": tool_call["id"], "content": tool_output})
+            # conversions have a fixed answer template, so format them here instead of asking the model
+            answer = _render_locally(tool_calls, tool_outputs)
+            if answer is not None:
+                return _finish(answer)
             # loop again to allow the model to make another tool call if it wants
             continue
 
         # no further tool calls; return final assistant message
-        return message.content or ""
+        if write is not None:
+            if truncated:
+                write(TRUNCATED_NOTE)
+            return "".join(transcript)
+        return _finish((content or "") + (TRUNCATED_NOTE if truncated else ""))
 
     # fallback if too many tool calls
-    return "I made too many tool calls for this request. Please refine your question."
+    return _finish("I made too many tool calls for this request. Please refine your question.")
+
+# ---- Batch processing (many independent questions under OpenAI rate limits) ----
+class _TokenBucket:
+    """Continuously refilling budget of `per_minute` units (requests or tokens)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity)  # an oversize request waits for a full bucket, not forever
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated_at) * self.capacity / 60)
+                self.updated_at = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) * 60 / self.capacity)
+
+_TOOLS_CHARS = len(orjson.dumps(TOOLS))
+
+def _estimate_tokens(messages: list, max_tokens: int) -> int:
+    # rough chars/4 heuristic over the full request (system prompt, tool outputs and specs are resent
+    # on every hop); OpenAI also counts max_tokens against TPM up front
+    return (len(orjson.dumps(messages)) + _TOOLS_CHARS) // 4 + max_tokens
+
+class _RateLimiter:
+    """Per-completion RPM/TPM throttle with rate-limit retries, shared by every conversation in a batch."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.request_bucket = _TokenBucket(rpm)
+        self.token_bucket = _TokenBucket(tpm)
+        # tenacity owns retrying here (rate limits and transport failures, which the SDK would otherwise
+        # retry itself); stacking the SDK's own retries would multiply the attempts
+        self.client = _get_openai_client().with_options(max_retries=0)
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)),
+        reraise=True,
+    )
+    async def create(self, **kwargs):
+        await self.request_bucket.acquire()
+        await self.token_bucket.acquire(_estimate_tokens(kwargs["messages"], kwargs.get("max_tokens") or 0))
+        return await self.client.chat.completions.create(**kwargs)
+
+async def run_batch(inputs: list[str], max_concurrency: int = 10, rpm: int = 500, tpm: int = 90_000) -> list:
+    """Run every input through run_conversation concurrently; each completion is throttled to
+    `rpm`/`tpm` and retried on rate limits and connection errors (cache hits and tool calls are
+    never charged or re-run).
+
+    Results come back in input order; an entry that still fails after retrying holds its exception.
+    The batch owns the HTTP/OpenAI clients of the running loop and closes them when it returns.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = _RateLimiter(rpm, tpm)
+
+    async def _worker(user_input: str) -> str:
+        async with semaphore:
+            return await run_conversation(user_input, limiter=limiter)
+
+    try:
+        return await asyncio.gather(*(_worker(user_input) for user_input in inputs), return_exceptions=True)
+    finally:
+        await close_http_clients()
+
+def _write_token(text: str) -> None:
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+async def _repl() -> None:
+    # prompt_async keeps the event loop running while the user types, so FX warm-up and
+    # connection keep-alives happen during think time instead of on the next request
+    session = PromptSession()
+    warm_rates_task = asyncio.create_task(_keep_rates_warm())
+    try:
+        while True:
+            try:
+                user_text = await session.prompt_async("You: ")
+            except (EOFError, KeyboardInterrupt):
+                break
+            if user_text.lower().strip() == "exit":
+                break
+            _write_token("AI: ")
+            await run_conversation(user_text, on_token=_write_token)
+            print()
+    finally:
+        warm_rates_task.cancel()
+        await close_http_clients()
 
 if __name__ == "__main__":
-    while True:
-        user_text = input("You: ")
-        if user_text.lower().strip() == "exit":
-            break
-        print("AI:", run_conversation(user_text))
+    asyncio.run(_repl())